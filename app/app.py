@@ -1,16 +1,24 @@
-import shutil
-import tempfile
+import hashlib
 import io
+import logging
+import operator
+from email.utils import formatdate, parsedate_to_datetime
+import stat
 import zipfile
+from typing import NamedTuple
 
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import Template
 import os
 
 from starlette.responses import StreamingResponse
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI()
 
 static_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
@@ -18,69 +26,250 @@ app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
 templates = Jinja2Templates(directory="/app/templates")
 
+DATA_ROOT = '/app/data'
+DATA_ROOT_REAL = os.path.realpath(DATA_ROOT)
+
+# Large reads keep the number of syscalls and ASGI sends per byte low.
+DEFAULT_STREAM_CHUNK_SIZE = 1 << 20
+
+
+def read_stream_chunk_size():
+    value = os.environ.get('FB_STREAM_CHUNK')
+    if value is None:
+        return DEFAULT_STREAM_CHUNK_SIZE
+    try:
+        chunk_size = int(value)
+    except ValueError:
+        chunk_size = 0
+    if chunk_size <= 0:
+        logger.warning("Ignoring FB_STREAM_CHUNK=%r: expected a positive integer, using %d",
+                       value, DEFAULT_STREAM_CHUNK_SIZE)
+        return DEFAULT_STREAM_CHUNK_SIZE
+    return chunk_size
+
+
+STREAM_CHUNK_SIZE = read_stream_chunk_size()
+
+# Level 1 deflate is several times faster than the default level 6 for a
+# marginally larger archive, which is the right tradeoff for a download.
+ZIP_COMPRESSLEVEL = 1
+
+# Already-compressed formats gain nothing from deflate, so they are stored as-is.
+INCOMPRESSIBLE_EXTENSIONS = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic',
+    '.mp4', '.mkv', '.avi', '.mov', '.webm', '.m4v',
+    '.mp3', '.aac', '.m4a', '.ogg', '.opus', '.flac',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.7z', '.rar',
+    '.pdf', '.docx', '.xlsx', '.pptx', '.epub',
+})
+
+
+class FileRow(NamedTuple):
+    name: str
+    size: int
+    path: str
+
+
+class DirRow(NamedTuple):
+    name: str
+    path: str
+
+
+class Listing(NamedTuple):
+    files: tuple
+    directories: tuple
+    fingerprint: str
+    mtime_ns: int
+
+
+class BrowsePage(NamedTuple):
+    stat_result: os.stat_result
+    template: Template
+    template_mtime_ns: int
+    listing: Listing
+
+
+class ZipBuffer(io.RawIOBase):
+    """Unseekable sink that collects zip output until it is drained."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def is_within_data_root(full_path):
+    return os.path.commonpath([full_path, DATA_ROOT_REAL]) == DATA_ROOT_REAL
+
+
+def iter_zip(dir_path):
+    buffer = ZipBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, compresslevel=ZIP_COMPRESSLEVEL) as zipf:
+        for root, _, files in os.walk(dir_path):
+            for file in files:
+                file_path_abs = os.path.join(root, file)
+                relative_path = os.path.relpath(file_path_abs, dir_path)
+                if not is_within_data_root(os.path.realpath(file_path_abs)):
+                    logger.warning("Skipping %s in zip: points outside %s", file_path_abs, DATA_ROOT)
+                    continue
+                # The response has already started, so a member that can't be
+                # read is skipped rather than aborting the whole archive.
+                try:
+                    zinfo = zipfile.ZipInfo.from_file(file_path_abs, arcname=relative_path,
+                                                      strict_timestamps=False)
+                    _, dot, ext = file.rpartition('.')
+                    if dot and '.' + ext.lower() in INCOMPRESSIBLE_EXTENSIONS:
+                        zinfo.compress_type = zipfile.ZIP_STORED
+                    else:
+                        zinfo.compress_type = zipf.compression
+                        zinfo._compresslevel = zipf.compresslevel
+                    with open(file_path_abs, 'rb') as src, zipf.open(zinfo, 'w') as dest:
+                        while True:
+                            data = src.read(STREAM_CHUNK_SIZE)
+                            if not data:
+                                break
+                            dest.write(data)
+                            chunk = buffer.drain()
+                            if chunk:
+                                yield chunk
+                except (OSError, ValueError) as e:
+                    # ValueError covers names zipfile can't encode.
+                    logger.warning("Skipping %s in zip: %s", file_path_abs, e)
+                chunk = buffer.drain()
+                if chunk:
+                    yield chunk
+    yield buffer.drain()
+
+
+def resolve_data_path(rel_path):
+    """Resolve a path relative to DATA_ROOT, refusing anything that escapes it."""
+    if '\x00' in rel_path:
+        raise HTTPException(status_code=400, detail='Invalid path')
+    full_path = os.path.realpath(os.path.join(DATA_ROOT_REAL, rel_path.lstrip('/')))
+    if not is_within_data_root(full_path):
+        raise HTTPException(status_code=404, detail='File or directory not found')
+    return full_path
+
+
+def scan_directory(path):
+    """List a directory as sorted file and directory rows with DATA_ROOT-relative paths.
+
+    The listing also carries a fingerprint over every entry's name and every
+    file's size and mtime, plus the newest file mtime. Unlike the directory's
+    own mtime, these change when a file is edited in place.
+    """
+    prefix_len = len(DATA_ROOT_REAL) + 1
+    files = []
+    directories = []
+    with os.scandir(path) as it:
+        for entry in it:
+            sort_key = entry.name.lower()
+            rel_path = entry.path[prefix_len:]
+            if entry.is_file():
+                stat_result = entry.stat()
+                files.append((sort_key, FileRow(entry.name, stat_result.st_size, rel_path), stat_result.st_mtime_ns))
+            else:
+                directories.append((sort_key, DirRow(entry.name, rel_path)))
+    files.sort(key=operator.itemgetter(0))
+    directories.sort(key=operator.itemgetter(0))
+
+    digest = hashlib.blake2b(digest_size=8)
+    for _, row, mtime_ns in files:
+        digest.update(f'{row.name}\0{row.size}\0{mtime_ns}\n'.encode('utf-8', 'surrogateescape'))
+    for _, row in directories:
+        digest.update(f'{row.name}/\n'.encode('utf-8', 'surrogateescape'))
+
+    return Listing(files=tuple(row for _, row, _ in files),
+                   directories=tuple(row for _, row in directories),
+                   fingerprint=digest.hexdigest(),
+                   mtime_ns=max((mtime_ns for _, _, mtime_ns in files), default=0))
+
+
+def load_browse_page(directories, template_name):
+    """Do all of a listing page's blocking work in one go: stat, template lookup, scan."""
+    browse_directory_path = resolve_data_path(directories)
+    try:
+        stat_result = os.stat(browse_directory_path)
+    except OSError:
+        raise HTTPException(status_code=500, detail='Invalid directory path')
+    if not stat.S_ISDIR(stat_result.st_mode):
+        raise HTTPException(status_code=500, detail='Invalid directory path')
+
+    # get_template goes through Jinja's auto-reload check, which stats the file.
+    template = templates.get_template(template_name)
+    template_mtime_ns = os.stat(template.filename).st_mtime_ns
+    return BrowsePage(stat_result, template, template_mtime_ns, scan_directory(browse_directory_path))
+
+
+def not_modified(request, etag, last_modified):
+    """Evaluate the request's conditional headers against a resource's validators."""
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+    if if_modified_since is None:
+        return False
+    try:
+        return last_modified <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
 
 @app.post('/download')
 async def download_file(request: Request):
     form_data = await request.form()
-    file_path = form_data["file_path"]
+    file_path = await run_in_threadpool(resolve_data_path, form_data["file_path"])
     file_name = form_data["file_name"]
 
-    if os.path.isfile(file_path):
-        return FileResponse(file_path, filename=file_name)
-    elif os.path.isdir(file_path):
-        temp_dir = tempfile.mkdtemp()
-        zip_path = os.path.join(temp_dir, file_name + '.zip')
-
-        async def create_zip():
-            print(f"Creating zipfile. {zip_path}")
-            with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, _, files in os.walk(file_path):
-                    for file in files:
-                        file_path_abs = os.path.join(root, file)
-                        relative_path = os.path.relpath(file_path_abs, file_path)
-                        zipf.write(file_path_abs, arcname=relative_path)
-
-        await create_zip()
-
-        def cleanup():
-            print(f"Removing temp_dir. {temp_dir}")
-
-            shutil.rmtree(temp_dir, ignore_errors=True)
-
-        async def stream_zip():
-            with open(zip_path, 'rb') as f:
-                while True:
-                    data = f.read(4096)
-                    if not data:
-                        break
-                    yield data
-            cleanup()
-
-        return StreamingResponse(stream_zip(), media_type='application/zip',
-                                 headers={'Content-Disposition': f'attachment; filename="{file_name}.zip"'})
+    try:
+        stat_result = await run_in_threadpool(os.stat, file_path)
+    except OSError:
+        raise HTTPException(status_code=404, detail='File or directory not found')
 
+    if stat.S_ISREG(stat_result.st_mode):
+        return FileResponse(file_path, filename=file_name, stat_result=stat_result)
+    elif stat.S_ISDIR(stat_result.st_mode):
+        return StreamingResponse(iter_zip(file_path), media_type='application/zip',
+                                 headers={'Content-Disposition': f'attachment; filename="{file_name}.zip"'})
     else:
         raise HTTPException(status_code=404, detail='File or directory not found')
 
 
-@app.get('/')
-@app.get('/{directories:path}')
-def browse_directory(request: Request, directories: str):
-    browse_directory_path = '/app/data' + directories
-    if not os.path.isdir(browse_directory_path):
-        raise HTTPException(status_code=500, detail='Invalid directory path')
+@app.api_route('/', methods=['GET', 'HEAD'])
+@app.api_route('/{directories:path}', methods=['GET', 'HEAD'])
+async def browse_directory(request: Request, directories: str):
+    page = await run_in_threadpool(load_browse_page, directories, "file_browser.html")
+    listing = page.listing
 
-    files = []
-    directories = []
-    for entry in os.scandir(browse_directory_path):
-        if entry.is_file():
-            file_data = {
-                'name': entry.name,
-                'size': entry.stat().st_size,
-                'path': entry.path
-            }
-            files.append(file_data)
-        else:
-            directories.append(entry)
-    return templates.TemplateResponse("file_browser.html",
-                                      {"request": request, "files": files, "directories": directories})
+    # The page shows names and sizes, so the validators have to track file
+    # edits too, not just the directory's own mtime.
+    etag = f'W/"{listing.fingerprint}-{page.template_mtime_ns:x}"'
+    last_modified = max(page.stat_result.st_mtime_ns, listing.mtime_ns, page.template_mtime_ns) // 1_000_000_000
+    headers = {
+        'ETag': etag,
+        'Last-Modified': formatdate(last_modified, usegmt=True),
+        'Cache-Control': 'no-cache',
+    }
+    if not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    if request.method == 'HEAD':
+        # The body isn't rendered, so there is no length to report; drop the
+        # content-length: 0 Response would otherwise claim for the page.
+        response = Response(headers=headers, media_type='text/html')
+        del response.headers['content-length']
+        return response
+
+    return HTMLResponse(page.template.render(request=request, files=listing.files, directories=listing.directories),
+                        headers=headers)